@@ -1,88 +1,296 @@
 import streamlit as st
 import pandas as pd
-import plotly.express as px
 import requests
-import json
-from typing import Union
-from openai import OpenAI
-import os
-import tempfile
+from requests.adapters import HTTPAdapter
+import orjson
+from typing import Dict, Iterator, Optional, Union
+import hashlib
+import io
+import re
+import threading
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+
+# (连接超时, 读取超时)，单位秒
+_REQUEST_TIMEOUT = (5, 30)
+
+# 各模型服务的地址，用于提前建立连接
+_BASE_URLS = {
+    "DeepSeek": "https://api.deepseek.com",
+    "Qwen": "https://dashscope.aliyuncs.com",
+    "Kimi": "https://api.moonshot.cn",
+    "豆包": "https://open.byteflowapi.com",
+    "智谱": "https://open.bigmodel.cn",
+}
+
+# 系统提示词中最多完整列出的列数，超出部分按类型汇总
+_PROMPT_MAX_COLUMNS = 40
+
+# 匹配响应中的Python代码块
+_CODE_RE = re.compile(r"```python\s*\n(.*?)```", re.DOTALL)
+
+# 生成代码中的控件调用（含 st.sidebar.xxx、col.xxx 等写法）；控件依赖当前会话的状态，不能从缓存回放
+_WIDGET_RE = re.compile(
+    r"\.(?:button|download_button|form_submit_button|checkbox|toggle|radio|"
+    r"selectbox|multiselect|select_slider|slider|text_input|number_input|text_area|"
+    r"date_input|time_input|file_uploader|camera_input|color_picker|data_editor|"
+    r"chat_input|pills|segmented_control|feedback)\s*\("
+)
+
+# 执行结果缓存最多保留的代码块数
+_RUN_CACHE_MAX_ENTRIES = 64
+
+# 解析结果缓存的有效期（秒）和最多保留的文件数
+_UPLOAD_CACHE_TTL = 3600
+_UPLOAD_CACHE_MAX_ENTRIES = 16
+
+# 聊天记录最多保留的消息数
+_CHAT_HISTORY_MAX_LEN = 200
+
+# 响应缓存的有效期（秒）和最大条目数
+_CACHE_TTL = 3600
+_CACHE_MAX_ENTRIES = 256
+
+
+@st.cache_resource
+def _get_session() -> requests.Session:
+    """进程级共享的HTTP会话，切换API Key或模型时连接池不会被丢弃"""
+    session = requests.Session()
+    session.headers.update({"Content-Type": "application/json"})
+    session.mount("https://", HTTPAdapter(pool_connections=4, pool_maxsize=32, max_retries=0))
+    return session
+
+
+def _prewarm(api_type: str):
+    """在后台向模型服务发送HEAD请求，让TCP+TLS握手与用户输入的时间重叠"""
+    url = _BASE_URLS.get(api_type)
+    if url is None:
+        return
+    session = _get_session()
+
+    def warm():
+        try:
+            session.head(url, timeout=2)
+        except requests.RequestException:
+            pass
+
+    threading.Thread(target=warm, daemon=True).start()
+
+
+def _iter_stream(response: requests.Response) -> Iterator[str]:
+    """逐行解析SSE流，依次返回增量文本"""
+    # 读到流结束而不是在 [DONE] 处中断，这样连接才能回到连接池
+    for line in response.iter_lines():
+        if not line.startswith(b"data: "):
+            continue
+        payload = line[6:]
+        if payload == b"[DONE]":
+            continue
+        chunk = orjson.loads(payload)
+        # 部分服务最后会发送 choices 为空的用量统计块
+        choices = chunk.get("choices")
+        if not choices:
+            continue
+        yield choices[0].get("delta", {}).get("content") or ""
+
+
+class _ResponseCache:
+    """按提示词哈希缓存完整的LLM响应，带过期时间的LRU"""
+
+    def __init__(self, ttl: float, max_entries: int):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: str):
+        with self._lock:
+            item = self._items.get(key)
+            if item is None:
+                return None
+            created, value = item
+            if time.monotonic() - created > self.ttl:
+                del self._items[key]
+                return None
+            self._items.move_to_end(key)
+            return value
+
+    def put(self, key: str, value: str):
+        with self._lock:
+            self._items[key] = (time.monotonic(), value)
+            self._items.move_to_end(key)
+            while len(self._items) > self.max_entries:
+                self._items.popitem(last=False)
+
+
+@st.cache_resource
+def _get_response_cache() -> _ResponseCache:
+    """进程级共享的响应缓存"""
+    return _ResponseCache(_CACHE_TTL, _CACHE_MAX_ENTRIES)
+
+
+def _cache_key(api_type: str, api_key: str, system_prompt: str, query: str) -> str:
+    """由模型、API Key哈希和完整提示词计算缓存键"""
+    api_key_hash = hashlib.sha256(api_key.encode()).hexdigest()
+    raw = "\0".join([api_type, api_key_hash, system_prompt, query])
+    return hashlib.sha256(raw.encode()).hexdigest()
+
+
+def _describe_columns(df: pd.DataFrame) -> str:
+    """列出数据集的列；列很多时只列出前若干列并附上各类型的列数"""
+    # Excel表头为数字时列名不是字符串
+    columns = list(map(str, df.columns))
+    if len(columns) <= _PROMPT_MAX_COLUMNS:
+        return ', '.join(columns)
+    dtype_counts = {dtype: int(count) for dtype, count in df.dtypes.astype(str).value_counts().items()}
+    return (f"共{len(columns)}列（前{_PROMPT_MAX_COLUMNS}列）：{', '.join(columns[:_PROMPT_MAX_COLUMNS])}；"
+            f"各类型列数：{dtype_counts}")
+
+
+def _build_system_prompt(df: pd.DataFrame) -> str:
+    """根据数据集的列和形状生成系统提示词"""
+    return f"""你是一个数据分析助手。当前数据集包含以下列：
+{_describe_columns(df)}
+数据形状：{df.shape}
+
+你的任务是：
+1. 理解用户的数据分析需求
+2. 生成相应的Python代码
+3. 返回格式化的Markdown代码块，其中包含可执行的Python代码
+
+注意：
+- 使用 'df' 作为数据框的变量名
+- 对于可视化，使用 plotly.express
+- 代码应该可以直接在Streamlit环境中运行
+- 如果需要显示图表，使用 st.plotly_chart()
+"""
+
+
+@st.cache_data(show_spinner="正在解析文件...", ttl=_UPLOAD_CACHE_TTL, max_entries=_UPLOAD_CACHE_MAX_ENTRIES)
+def _parse_upload(name: str, data: bytes) -> pd.DataFrame:
+    """解析上传的文件；按文件内容缓存，重建分析器时不再重复解析"""
+    bio = io.BytesIO(data)
+    if name.endswith('.csv'):
+        return pd.read_csv(bio)
+    return pd.read_excel(bio)
 
 
 class DataAnalyzer:
+    # API类型 -> 对应的调用方法名
+    _DISPATCH = {
+        "DeepSeek": "_call_deepseek",
+        "Qwen": "_call_qwen",
+        "Kimi": "_call_kimi",
+        "豆包": "_call_doubao",
+        "智谱": "_call_zhipu",
+    }
+
     def __init__(self, api_key: str, api_type: str):
         self.api_key = api_key
         self.api_type = api_type
         self.df = None
+        # 系统提示词只依赖数据集，加载数据时生成一次
+        self._system_prompt: Optional[str] = None
+        # 复用同一个连接池，避免每次调用都重新进行TCP+TLS握手
+        self._session = _get_session()
+        self._cache = _get_response_cache()
 
     def load_data(self, file: Union[str, bytes]) -> bool:
         """加载数据文件"""
         try:
-            if file.name.endswith('.xlsx'):
-                self.df = pd.read_excel(file)
-            elif file.name.endswith('.csv'):
-                self.df = pd.read_csv(file)
+            if file.name.endswith(('.xlsx', '.csv')):
+                self.df = _parse_upload(file.name, file.getvalue())
+                self._system_prompt = _build_system_prompt(self.df)
             return True
         except Exception as e:
             st.error(f"文件加载错误: {str(e)}")
             return False
 
-    def process_query(self, query: str) -> str:
-        """处理用户查询"""
+    def process_query(self, query: str) -> Iterator[str]:
+        """处理用户查询，以流式方式逐段返回响应"""
         if self.df is None:
-            return "请先上传数据文件"
+            yield "请先上传数据文件"
+            return
 
-        system_prompt = f"""你是一个数据分析助手。当前数据集包含以下列：
-{', '.join(self.df.columns)}
-数据形状：{self.df.shape}
+        system_prompt = self._system_prompt
 
-你的任务是：
-1. 理解用户的数据分析需求
-2. 生成相应的Python代码
-3. 返回格式化的Markdown代码块，其中包含可执行的Python代码
+        # temperature较低，相同的数据和问题会得到基本一致的回答，直接复用缓存
+        key = _cache_key(self.api_type, self.api_key, system_prompt, query)
+        cached = self._cache.get(key)
+        if cached is not None:
+            yield cached
+            return
 
-注意：
-- 使用 'df' 作为数据框的变量名
-- 对于可视化，使用 plotly.express
-- 代码应该可以直接在Streamlit环境中运行
-- 如果需要显示图表，使用 st.plotly_chart()
-"""
+        method = getattr(self, self._DISPATCH.get(self.api_type, ""), None)
+        if method is None:
+            yield "不支持的API类型"
+            return
 
         try:
-            if self.api_type == "DeepSeek":
-                return self._call_deepseek(system_prompt, query)
-            elif self.api_type == "Qwen":
-                return self._call_qwen(system_prompt, query)
-            elif self.api_type == "Kimi":
-                return self._call_kimi(system_prompt, query)
-            elif self.api_type == "豆包":
-                return self._call_doubao(system_prompt, query)
-            elif self.api_type == "智谱":
-                return self._call_zhipu(system_prompt, query)
-            else:
-                return "不支持的API类型"
+            stream = method(system_prompt, query)
+            chunks = []
+            for chunk in stream:
+                chunks.append(chunk)
+                yield chunk
         except Exception as e:
-            return f"API调用失败: {str(e)}"
+            yield f"API调用失败: {str(e)}"
+            return
+
+        # 只缓存完整读取的成功响应
+        self._cache.put(key, "".join(chunks))
+
+    def process_queries(self, query: str, api_keys: Dict[str, str]) -> Dict[str, str]:
+        """将同一查询并发发送给多个模型，返回 {API类型: 完整响应}"""
+        if not api_keys:
+            return {}
+
+        analyzers = {}
+        for api_type, api_key in api_keys.items():
+            analyzer = DataAnalyzer(api_key, api_type)
+            analyzer.df = self.df
+            analyzer._system_prompt = self._system_prompt
+            analyzers[api_type] = analyzer
+
+        # 请求都在等待网络，用线程并发后总耗时约等于最慢的那个模型
+        with ThreadPoolExecutor(max_workers=len(analyzers)) as pool:
+            futures = {
+                api_type: pool.submit(lambda a: "".join(a.process_query(query)), analyzer)
+                for api_type, analyzer in analyzers.items()
+            }
+        return {api_type: future.result() for api_type, future in futures.items()}
+
+    def _post(self, url, headers, data):
+        """发送流式请求，超时后重试一次"""
+        for attempt in range(2):
+            try:
+                # Content-Type: application/json 已在共享会话上设置
+                response = self._session.post(
+                    url, headers=headers, data=orjson.dumps(data), timeout=_REQUEST_TIMEOUT, stream=True
+                )
+                response.raise_for_status()
+                return response
+            except requests.Timeout:
+                if attempt == 1:
+                    raise
 
     def _call_deepseek(self, system_prompt, query):
-        headers = {
-            "Content-Type": "application/json",
-            "Authorization": f"Bearer {self.api_key}"
-        }
+        headers = {"Authorization": f"Bearer {self.api_key}"}
         data = {
             "model": "deepseek-chat",
             "messages": [
                 {"role": "system", "content": system_prompt},
                 {"role": "user", "content": query}
             ],
-            "temperature": 0.1
+            "temperature": 0.1,
+            "stream": True
         }
-        response = requests.post(
+        response = self._post(
             "https://api.deepseek.com/v1/chat/completions",
-            headers=headers,
-            json=data
+            headers,
+            data
         )
-        return response.json()["choices"][0]["message"]["content"]
+        return _iter_stream(response)
 
     #
     # def _call_qwen(self, system_prompt, query):
@@ -106,84 +314,112 @@ class DataAnalyzer:
     #     return response.json()["output"]["choices"][0]["message"]["content"]
 
     def _call_qwen(self, system_prompt, query):
-        headers = {
-            "Content-Type": "application/json",
-            "Authorization": f"Bearer {self.api_key}"
-        }
+        headers = {"Authorization": f"Bearer {self.api_key}"}
         data = {
             "model": "deepseek-r1-distill-qwen-7b",
             "messages": [
                 {"role": "system", "content": system_prompt},
                 {"role": "user", "content": query}
             ],
-            "temperature": 0.1
+            "temperature": 0.1,
+            "stream": True
         }
-        response = requests.post(
+        response = self._post(
             "https://dashscope.aliyuncs.com/compatible-mode/v1",
-            headers=headers,
-            json=data
+            headers,
+            data
         )
-        return response.json()["choices"][0]["message"]["content"]
+        return _iter_stream(response)
 
     def _call_kimi(self, system_prompt, query):
-        headers = {
-            "Content-Type": "application/json",
-            "Authorization": f"Bearer {self.api_key}"
-        }
+        headers = {"Authorization": f"Bearer {self.api_key}"}
         data = {
             "model": "moonshot-v1-8k",
             "messages": [
                 {"role": "system", "content": system_prompt},
                 {"role": "user", "content": query}
             ],
-            "temperature": 0.1
+            "temperature": 0.1,
+            "stream": True
         }
-        response = requests.post(
+        response = self._post(
             "https://api.moonshot.cn/v1/chat/completions",
-            headers=headers,
-            json=data
+            headers,
+            data
         )
-        return response.json()["choices"][0]["message"]["content"]
+        return _iter_stream(response)
 
     def _call_doubao(self, system_prompt, query):
-        headers = {
-            "Content-Type": "application/json",
-            "Authorization": f"Bearer {self.api_key}"
-        }
+        headers = {"Authorization": f"Bearer {self.api_key}"}
         data = {
             "model": "skylark2-pro-4k",
             "messages": [
                 {"role": "system", "content": system_prompt},
                 {"role": "user", "content": query}
             ],
-            "temperature": 0.1
+            "temperature": 0.1,
+            "stream": True
         }
-        response = requests.post(
+        response = self._post(
             "https://open.byteflowapi.com/api/v1/chat/completions",
-            headers=headers,
-            json=data
+            headers,
+            data
         )
-        return response.json()["choices"][0]["message"]["content"]
+        return _iter_stream(response)
 
     def _call_zhipu(self, system_prompt, query):
-        headers = {
-            "Content-Type": "application/json",
-            "Authorization": f"Bearer {self.api_key}"
-        }
+        headers = {"Authorization": f"Bearer {self.api_key}"}
         data = {
             "model": "chatglm-pro",
             "messages": [
                 {"role": "system", "content": system_prompt},
                 {"role": "user", "content": query}
             ],
-            "temperature": 0.1
+            "temperature": 0.1,
+            "stream": True
         }
-        response = requests.post(
+        response = self._post(
             "https://open.bigmodel.cn/api/paas/v3/chat/completions",
-            headers=headers,
-            json=data
+            headers,
+            data
         )
-        return response.json()["choices"][0]["message"]["content"]
+        return _iter_stream(response)
+
+
+def _extract_code(content: str) -> Optional[str]:
+    """提取消息中的Python代码块，没有则返回None"""
+    m = _CODE_RE.search(content)
+    return m.group(1) if m else None
+
+
+@st.cache_resource(max_entries=64, show_spinner=False)
+def _compile(code: str):
+    """编译生成的代码；代码对象无法序列化，因此用cache_resource缓存"""
+    return compile(code, "<llm-code>", "exec")
+
+
+def _exec_code(code: str):
+    """在当前会话的数据框上执行生成的代码"""
+    # plotly导入较慢，只在确实要执行代码时才加载
+    import plotly.express as px
+
+    # 只暴露生成代码需要的名字，不使用当前模块的全局命名空间
+    namespace = {"df": st.session_state.analyzer.df, "st": st, "px": px, "pd": pd}
+    exec(_compile(code), namespace)
+
+
+@st.cache_data(max_entries=_RUN_CACHE_MAX_ENTRIES, show_spinner=False)
+def _replay_code(code: str, df_hash: str):
+    """按代码和数据文件内容缓存执行结果，重新渲染时直接回放输出而不再执行"""
+    _exec_code(code)
+
+
+def _run_code(code: str, df_hash: str):
+    """执行生成的代码；包含控件的代码每次都重新执行，其余的从缓存回放"""
+    if _WIDGET_RE.search(code):
+        _exec_code(code)
+    else:
+        _replay_code(code, df_hash)
 
 
 def main():
@@ -201,6 +437,11 @@ def main():
             help="选择需要使用的AI模型"
         )
 
+        # 切换模型时提前建立连接，首次提问无需再等待握手
+        if st.session_state.get('prewarmed_api_type') != api_type:
+            st.session_state.prewarmed_api_type = api_type
+            _prewarm(api_type)
+
         # 根据选择的API类型显示对应的输入框
         api_key = st.text_input(
             f"输入{api_type} API Key",
@@ -219,7 +460,17 @@ def main():
         st.session_state.analyzer = None
 
     if 'chat_history' not in st.session_state:
-        st.session_state.chat_history = []
+        # 限制长度，长时间会话中每次重新渲染的开销保持不变
+        st.session_state.chat_history = deque(maxlen=_CHAT_HISTORY_MAX_LEN)
+
+    # 数据与分析器分开保存，切换API Key或模型时无需重新解析文件
+    if 'df' not in st.session_state:
+        st.session_state.df = None
+        # 每次上传都会生成新的file_id，同名同大小的不同文件也能区分
+        st.session_state.df_file_id = None
+        # 数据文件内容的哈希，作为执行结果缓存的键
+        st.session_state.df_hash = None
+        st.session_state.system_prompt = None
 
     # 设置API key和加载数据
     if api_key and uploaded_file:
@@ -227,9 +478,17 @@ def main():
                 st.session_state.analyzer.api_type != api_type or \
                 st.session_state.analyzer.api_key != api_key:
             st.session_state.analyzer = DataAnalyzer(api_key, api_type)
+            st.session_state.analyzer.df = st.session_state.df
+            st.session_state.analyzer._system_prompt = st.session_state.system_prompt
 
-        if st.session_state.analyzer.df is None:
+        # 只有上传了不同的文件时才重新解析
+        if st.session_state.df is None or \
+                st.session_state.get('df_file_id') != uploaded_file.file_id:
             if st.session_state.analyzer.load_data(uploaded_file):
+                st.session_state.df = st.session_state.analyzer.df
+                st.session_state.df_file_id = uploaded_file.file_id
+                st.session_state.df_hash = hashlib.sha256(uploaded_file.getvalue()).hexdigest()
+                st.session_state.system_prompt = st.session_state.analyzer._system_prompt
                 st.success("数据加载成功！")
                 # 显示数据预览
                 st.subheader("数据预览")
@@ -238,6 +497,20 @@ def main():
     # 聊天界面
     st.subheader("💬 与AI对话")
 
+    # 显示聊天历史
+    for message in st.session_state.chat_history:
+        with st.chat_message(message["role"]):
+            st.markdown(message["content"])
+
+            # 如果消息中包含代码块，则尝试执行
+            code = message.get("code")
+            if code is not None:
+                try:
+                    with st.expander("查看执行结果"):
+                        _run_code(code, st.session_state.df_hash)
+                except Exception as e:
+                    st.error(f"代码执行错误: {str(e)}")
+
     # 用户输入
     user_input = st.chat_input("输入你的数据分析需求...")
 
@@ -248,25 +521,19 @@ def main():
 
         # 添加用户消息到历史
         st.session_state.chat_history.append({"role": "user", "content": user_input})
+        with st.chat_message("user"):
+            st.markdown(user_input)
+
+        # 流式显示AI响应
+        with st.chat_message("assistant"):
+            response = st.write_stream(st.session_state.analyzer.process_query(user_input))
+        # 代码块只在收到响应时提取一次，渲染历史时直接使用
+        st.session_state.chat_history.append(
+            {"role": "assistant", "content": response, "code": _extract_code(response)}
+        )
 
-        # 获取AI响应
-        with st.spinner("AI正在思考..."):
-            response = st.session_state.analyzer.process_query(user_input)
-            st.session_state.chat_history.append({"role": "assistant", "content": response})
-
-    # 显示聊天历史
-    for message in st.session_state.chat_history:
-        with st.chat_message(message["role"]):
-            st.markdown(message["content"])
-
-            # 如果消息中包含代码块，则尝试执行
-            if message["role"] == "assistant" and "```python" in message["content"]:
-                code = message["content"].split("```python")[1].split("```")[0]
-                try:
-                    with st.expander("查看执行结果"):
-                        exec(code)
-                except Exception as e:
-                    st.error(f"代码执行错误: {str(e)}")
+        # 重新运行脚本，由聊天历史统一渲染并执行响应中的代码
+        st.rerun()
 
 
 if __name__ == "__main__":